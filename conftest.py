@@ -0,0 +1 @@
+"""Keeps the repository root importable so tests can import main"""
@@ -4,29 +4,211 @@ pull tabular information from documents with GPT4o
 """
 import os
 import sys
+import asyncio
+import base64
 import csv
+import hashlib
+import io
 import json
+import re
+import tempfile
 import zipfile
+from datetime import datetime, timezone
 from typing import Annotated, Any, List
-from io import StringIO
 from documentcloud.addon import AddOn
 from documentcloud.exceptions import APIError
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError
 from pydantic import (
     BaseModel,
     BeforeValidator,
     PlainSerializer,
     InstanceOf,
+    ValidationError,
     WithJsonSchema,
 )
+import httpx
 import instructor
+from instructor.core import (
+    AsyncValidationError,
+    InstructorRetryException,
+    ValidationError as InstructorValidationError,
+)
+import orjson
 import pandas as pd
+from aiolimiter import AsyncLimiter
 
 from tenacity import (
+    AsyncRetrying,
     retry,
+    retry_if_exception,
+    retry_if_exception_type,
     stop_after_attempt,
+    wait_random,
     wait_random_exponential,
-)  # for exponential backoff
+)  # for jittered backoff
+
+
+MODEL = "gpt-4o"
+# Bump whenever the prompt, the table schema or the cache format changes
+# so stale cached results are not reused
+PROMPT_VERSION = "3"
+
+
+def cache_key(image: bytes, prompt: str, model: str) -> str:
+    """ Hashes the page image together with the prompt and model,
+        length-prefixing each part so different splits cannot collide
+    """
+    digest = hashlib.sha256()
+    for part in (image, f"{PROMPT_VERSION}:{prompt}".encode("utf-8"), model.encode("utf-8")):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError)
+# Bad model output; worth asking again
+VALIDATION_ERRORS = (
+    ValidationError,
+    json.JSONDecodeError,
+    InstructorValidationError,
+    AsyncValidationError,
+)
+
+
+def unwrap_api_error(exc: BaseException) -> BaseException:
+    """ instructor wraps API errors in InstructorRetryException,
+        so dig out the error from its last attempt
+    """
+    if isinstance(exc, InstructorRetryException):
+        last_attempt = getattr(exc.__cause__, "last_attempt", None)
+        if last_attempt is not None and last_attempt.exception() is not None:
+            return last_attempt.exception()
+    return exc
+
+
+def is_retryable_error(exc: BaseException) -> bool:
+    """ Whether the (possibly wrapped) error is worth retrying"""
+    return isinstance(unwrap_api_error(exc), TRANSIENT_ERRORS + VALIDATION_ERRORS)
+
+
+def is_transient_fetch_error(exc: BaseException) -> bool:
+    """ Whether downloading a page image is worth trying again"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def wait_retry_after(fallback):
+    """ Waits for as long as OpenAI's Retry-After header asks on a rate limit,
+        otherwise defers to the fallback wait strategy
+    """
+    def wait(retry_state):
+        exc = unwrap_api_error(retry_state.outcome.exception())
+        if isinstance(exc, RateLimitError):
+            retry_after = exc.response.headers.get("retry-after")
+            try:
+                return float(retry_after) + wait_random(min=0, max=0.5)(retry_state)
+            except (TypeError, ValueError):
+                pass
+        return fallback(retry_state)
+    return wait
+
+
+def md_to_df(data: Any) -> Any:
+    if isinstance(data, str):
+        rows = []
+        for line in data.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            line = line.removeprefix("|").removesuffix("|")
+            rows.append([cell.strip() for cell in line.split("|")])
+        if not rows:
+            return pd.DataFrame()
+        header, body = rows[0], rows[1:]
+        # Skip the |---|:---:| separator row under the header
+        separator = "".join(body[0]) if body else ""
+        if "-" in separator and set(separator) <= set("-: "):
+            body = body[1:]
+        # Repeated headers (often several blank row-label columns) would collide,
+        # so suffix them .1, .2, ... the way read_csv does
+        used = set()
+        for position, name in enumerate(header):
+            candidate, suffix = name, 0
+            while candidate in used:
+                suffix += 1
+                candidate = f"{name}.{suffix}"
+            header[position] = candidate
+            used.add(candidate)
+        width = len(header)
+        for row in body:
+            # Extra cells mean the table is malformed; raising lets instructor re-ask
+            if len(row) > width:
+                raise ValueError(
+                    f"Markdown table row has {len(row)} cells but the header has {width}"
+                )
+        # Short rows are padded with empty cells
+        body = [row + [""] * (width - len(row)) for row in body]
+        return pd.DataFrame(body, columns=header)
+    return data
+
+
+MarkdownDataFrame = Annotated[
+    InstanceOf[pd.DataFrame],
+    BeforeValidator(md_to_df),
+    PlainSerializer(lambda x: x.to_markdown()),
+    WithJsonSchema(
+        {
+            "type": "string",
+            "description": """
+                The markdown representation of the table,
+                each one should be tidy, do not try to join tables
+                that should be seperate""",
+        }
+    ),
+]
+
+
+class Table(BaseModel):
+    """Where we define a table"""
+
+    caption: str
+    dataframe: MarkdownDataFrame
+
+
+class MultipleTables(BaseModel):
+    """Where we define multiple tables"""
+
+    tables: List[Table]
+
+
+example = MultipleTables(
+    tables=[
+        Table(
+            caption="This is a caption",
+            dataframe=pd.DataFrame(
+                {
+                    "Chart A": [10, 40],
+                    "Chart B": [20, 50],
+                    "Chart C": [30, 60],
+                }
+            ),
+        )
+    ]
+)
+
+DEFAULT_PROMPT_TEXT = """
+            Take a moment to reason about the best set of headers for the tables.
+            Write a good h1 for the image below. Then follow up with a short description of the what the data is about.
+            Then for each table you identified, write a h2 tag that is a descriptive title of the table.
+            Then follow up with a short description of the what the data is about.
+            Lastly, produce the markdown table for each table you identified.
+            Make sure to escape the markdown table properly, and make sure to include the caption and the dataframe.
+            including escaping all the newlines and quotes. Only return a markdown table in dataframe, nothing else.
+            """
+
+# The example never changes, so only serialize it once
+EXAMPLE_JSON = example.model_dump_json(indent=2)
 
 
 class Vision(AddOn):
@@ -34,25 +216,19 @@ class Vision(AddOn):
 
     def calculate_cost(self, documents):
         """ Given a set of documents, counts the number of pages and returns a cost"""
-        total_num_pages = 0
-        for doc in documents:
-            start_page = self.data.get("start_page", 1)
-            end_page = self.data.get("end_page")
-            last_page = 0
-            if end_page is None:
-                self.set_message(
-                    f"No end page provided. Please provide one and try again."
-                )
-                sys.exit(1)
-            if end_page < start_page:
-                self.set_message("You provided an end page that is smaller than the start page. Try again.")
-                sys.exit(1)
-            if end_page <= doc.page_count:
-                last_page = end_page
-            else:
-                last_page = doc.page_count
-            pages_to_analyze = last_page - start_page + 1
-            total_num_pages += pages_to_analyze
+        start_page = self.data.get("start_page", 1)
+        end_page = self.data.get("end_page")
+        if end_page is None:
+            self.set_message(
+                f"No end page provided. Please provide one and try again."
+            )
+            sys.exit(1)
+        if end_page < start_page:
+            self.set_message("You provided an end page that is smaller than the start page. Try again.")
+            sys.exit(1)
+        total_num_pages = sum(
+            max(min(end_page, doc.page_count) - start_page + 1, 0) for doc in documents
+        )
         cost = total_num_pages * 7
         print(cost)
         return cost
@@ -70,9 +246,16 @@ class Vision(AddOn):
         if not self.org_id:
             self.set_message("No organization to charge.")
             sys.exit(0)
-        ai_credit_cost = self.calculate_cost(
-            self.get_documents()
-        )
+        # Check options before charging so a bad value does not cost credits
+        if self.data.get("concurrency", 10) < 1:
+            self.set_message("Concurrency must be at least 1, please try again")
+            sys.exit(0)
+        if self.data.get("rpm", 500) < 1 or self.data.get("tpm", 450000) < 1:
+            self.set_message("The rpm and tpm limits must be at least 1, please try again")
+            sys.exit(0)
+        # Keep the documents around so main does not have to fetch them again
+        self._docs = list(self.get_documents())
+        ai_credit_cost = self.calculate_cost(self._docs)
         try:
             self.charge_credits(ai_credit_cost)
         except ValueError:
@@ -86,25 +269,33 @@ class Vision(AddOn):
         if not self.validate():
             self.set_message("You do not have sufficient AI credits to run this Add-On on this document set")
             sys.exit(0)
-        default_prompt_text = """
-            Take a moment to reason about the best set of headers for the tables.
-            Write a good h1 for the image above. Then follow up with a short description of the what the data is about.
-            Then for each table you identified, write a h2 tag that is a descriptive title of the table.
-            Then follow up with a short description of the what the data is about.
-            Lastly, produce the markdown table for each table you identified.
-            Make sure to escape the markdown table properly, and make sure to include the caption and the dataframe.
-            including escaping all the newlines and quotes. Only return a markdown table in dataframe, nothing else.
-            """
-        base_client = OpenAI(api_key=os.environ["TOKEN"])
+        asyncio.run(self._amain())
+
+    async def _amain(self):
+        """Extracts tables from every requested page concurrently"""
+        # Retries are owned by the tenacity decorator on extract, so every attempt
+        # goes back through the rate limiters
+        base_client = AsyncOpenAI(api_key=os.environ["TOKEN"], max_retries=0)
         client = instructor.from_openai(
             base_client,
             mode=instructor.Mode.MD_JSON,
         )
         prompt = self.data.get("prompt", "")
-        final_prompt = prompt + "\n" + default_prompt_text
+        final_prompt = prompt + "\n" + DEFAULT_PROMPT_TEXT
         output_format = self.data.get("output_format", "csv")
         start_page = self.data.get("start_page", 1)
         end_page = self.data.get("end_page", 1)
+        concurrency = self.data.get("concurrency", 10)
+        # OpenAI account limits; not exposed in config.yaml since they belong to
+        # whoever runs the Add-On rather than the person filling in the form
+        rpm = self.data.get("rpm", 500)
+        tpm = self.data.get("tpm", 450000)
+        # Not exposed in config.yaml: a batch can take up to 24 hours, far longer
+        # than the 60 minute Add-On workflow timeout
+        use_batch_api = self.data.get("use_batch_api", False)
+        cache_dir = self.data.get("cache_dir")
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
 
         if end_page < start_page:
             self.set_message("The end page you provided is smaller than the start page, try again")
@@ -113,154 +304,392 @@ class Vision(AddOn):
             self.set_message("Your start page is less than 1, please try again")
             sys.exit(0)
 
-        class TableEncoder(json.JSONEncoder):
-            """ Used to transform dataframe -> JSON 
-                output for save_tables_to_json
-            """
-            def default(self, o):
-                if isinstance(o, Table):
-                    cleaned_data = {}
-                    for key, value in o.dataframe.to_dict().items():
-                        cleaned_key = key.strip()
-                        cleaned_values = {
-                            sub_key.strip(): sub_value
+        def serialize_tables_to_json(tables, page_number) -> str:
+            payload = [
+                {
+                    "caption": table.caption,
+                    "dataframe": {
+                        str(key).strip(): {
+                            str(sub_key).strip(): sub_value
                             for sub_key, sub_value in value.items()
                         }
-                        cleaned_data[cleaned_key] = cleaned_values
-                    return {
-                        "caption": o.caption,
-                        "dataframe": cleaned_data,
-                    }
-                return super().default(o)
-
-        def save_tables_to_json(tables, json_file, page_number):
-            with open(json_file, "a", encoding="utf-8") as jsonfile:  # Append mode
-                jsonfile.write(f"Page number: {page_number}")
-                json.dump(tables, jsonfile, indent=4, cls=TableEncoder)
-                jsonfile.write('\n')
-                jsonfile.write('\n')
-                jsonfile.write('\n')
-
-        def save_tables_to_csv(tables, csv_file, page_number):
-            with open(csv_file, "a", newline="", encoding="utf-8") as csvfile:  # Append mode
-                writer = csv.writer(csvfile)
-                writer.writerow([f"Page Number: {page_number}"])  # Write the page number
-                for table in tables:
-                    writer.writerow([table.caption])
-                    writer.writerows(table.dataframe.values.tolist())
-                    writer.writerow([])  # Add empty rows between tables
-                    writer.writerow([])
-                    writer.writerow([])
-
-        def md_to_df(data: Any) -> Any:
-            if isinstance(data, str):
-                return (
-                    pd.read_csv(
-                        StringIO(data),  # Get rid of whitespaces
-                        sep="|",
-                        index_col=None,
-                    )
-                    .dropna(axis=1, how="all")
-                    .iloc[1:]
-                    .applymap(lambda x: x.strip() if isinstance(x, str) else x)
-                )
-            return data
+                        for key, value in table.dataframe.to_dict().items()
+                    },
+                }
+                for table in tables
+            ]
+            encoded = orjson.dumps(
+                payload, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+            ).decode("utf-8")
+            return f"Page number: {page_number}{encoded}\n\n\n"
+
+        def serialize_tables_to_csv(tables, page_number) -> str:
+            csvfile = io.StringIO()
+            writer = csv.writer(csvfile)
+            writer.writerow([f"Page Number: {page_number}"])  # Write the page number
+            for table in tables:
+                writer.writerow([table.caption])
+                writer.writerow(table.dataframe.columns.tolist())
+                writer.writerows(table.dataframe.itertuples(index=False, name=None))
+                writer.writerow([])  # Add empty rows between tables
+                writer.writerow([])
+                writer.writerow([])
+            return csvfile.getvalue()
+
+        # Everything except the image is the same for every page, so send it first
+        # as one block; OpenAI's prompt caching can then reuse it across pages
+        static_prefix = (
+            "Describe this data accurately as a table"
+            f" in markdown format. {EXAMPLE_JSON}\n{final_prompt}"
+        )
 
-        MarkdownDataFrame = Annotated[
-            InstanceOf[pd.DataFrame],
-            BeforeValidator(md_to_df),
-            PlainSerializer(lambda x: x.to_markdown()),
-            WithJsonSchema(
+        def build_messages(url: str) -> list:
+            return [
                 {
-                    "type": "string",
-                    "description": """
-                        The markdown representation of the table,
-                        each one should be tidy, do not try to join tables
-                        that should be seperate""",
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": static_prefix,
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": url},
+                        },
+                    ],
                 }
+            ]
+
+        @retry(
+            wait=wait_retry_after(
+                wait_random(min=0.1, max=0.5)
+                + wait_random_exponential(multiplier=0.2, max=10)
             ),
-        ]
+            stop=stop_after_attempt(6),
+            retry=retry_if_exception(is_retryable_error),
+        )
+        async def extract(url: str) -> MultipleTables:
+            # Rough token estimate: ~4 characters per token plus the completion budget
+            est_tokens = min(len(static_prefix) // 4 + 4000, tpm)
+            async with rpm_limiter:
+                await tpm_limiter.acquire(est_tokens)
+                tables = await client.chat.completions.create(
+                    model=MODEL,
+                    max_tokens=4000,
+                    # Let instructor re-ask on bad output as it does by default,
+                    # but hand API errors straight back to our own retry above
+                    max_retries=AsyncRetrying(
+                        stop=stop_after_attempt(3),
+                        retry=retry_if_exception_type(VALIDATION_ERRORS),
+                    ),
+                    response_model=MultipleTables,
+                    messages=build_messages(url),
+                )
 
-        class Table(BaseModel):
-            """Where we define a table"""
+            return tables
 
-            caption: str
-            dataframe: MarkdownDataFrame
+        async def batch_extract(jobs) -> List[MultipleTables]:
+            """ Runs every page through OpenAI's Batch API and returns
+                the parsed tables in the same order as jobs
+            """
+            # Mirror the instructions instructor adds in MD_JSON mode
+            system_message = {
+                "role": "system",
+                "content": "As a genius expert, your task is to understand the content "
+                "and provide the parsed objects in json that match the following "
+                f"json_schema:\n\n{json.dumps(MultipleTables.model_json_schema(), indent=2)}"
+                "\n\nMake sure to return an instance of the JSON, not the schema itself",
+            }
+            json_reminder = {
+                "role": "user",
+                "content": "Return the correct JSON response within a ```json codeblock. "
+                "not the JSON_SCHEMA",
+            }
+            if not jobs:
+                return []
 
-        class MultipleTables(BaseModel):
-            """Where we define multiple tables"""
+            # Build the JSONL in memory so no request file is left behind
+            lines = []
+            for document, page_number in jobs:
+                request = {
+                    "custom_id": f"{document.id}:{page_number}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": MODEL,
+                        "max_tokens": 4000,
+                        "messages": [system_message]
+                        + build_messages(document.get_large_image_url(page_number))
+                        + [json_reminder],
+                    },
+                }
+                lines.append(json.dumps(request))
+            batch_payload = ("\n".join(lines) + "\n").encode("utf-8")
 
-            tables: List[Table]
+            # The realtime client has SDK retries disabled; let these calls use them
+            batch_client = base_client.with_options(max_retries=2)
+            batch_file = await batch_client.files.create(
+                file=("batch_requests.jsonl", batch_payload), purpose="batch"
+            )
+            batch = await batch_client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+            )
 
-        example = MultipleTables(
-            tables=[
-                Table(
-                    caption="This is a caption",
-                    dataframe=pd.DataFrame(
-                        {
-                            "Chart A": [10, 40],
-                            "Chart B": [20, 50],
-                            "Chart C": [30, 60],
-                        }
-                    ),
+            delay = 5
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 300)
+                batch = await batch_client.batches.retrieve(batch.id)
+            if batch.status != "completed":
+                self.set_message(f"The OpenAI batch finished with status: {batch.status}")
+                sys.exit(1)
+            if batch.output_file_id is None:
+                # Every request failed, so only an error file was produced
+                reason = "no error details were returned"
+                if batch.error_file_id is not None:
+                    errors = await batch_client.files.content(batch.error_file_id)
+                    first_error = next(
+                        (json.loads(line) for line in errors.text.splitlines() if line.strip()),
+                        {},
+                    )
+                    body = (first_error.get("response") or {}).get("body") or {}
+                    reason = (body.get("error") or first_error.get("error") or {}).get(
+                        "message", reason
+                    )
+                self.set_message(f"Every request in the OpenAI batch failed: {reason}")
+                sys.exit(1)
+
+            output = await batch_client.files.content(batch.output_file_id)
+            parsed = {}
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                response = result.get("response") or {}
+                if response.get("status_code") != 200:
+                    print(f"Batch request {result['custom_id']} failed: {result.get('error')}")
+                    continue
+                choices = response.get("body", {}).get("choices") or [{}]
+                content = choices[0].get("message", {}).get("content")
+                if not content:
+                    print(f"Batch request {result['custom_id']} returned no content")
+                    continue
+                match = re.search(r"```(?:json)?\s*(.*?)\s*```", content, re.DOTALL)
+                try:
+                    parsed[result["custom_id"]] = MultipleTables.model_validate_json(
+                        match.group(1) if match else content
+                    )
+                except ValueError as exc:
+                    print(f"Could not parse batch result {result['custom_id']}: {exc}")
+
+            failed = sum(
+                f"{document.id}:{page_number}" not in parsed for document, page_number in jobs
+            )
+            if jobs and failed == len(jobs):
+                self.set_message("The OpenAI batch could not extract tables from any page.")
+                sys.exit(1)
+            if failed:
+                self.set_message(
+                    f"{failed} of {len(jobs)} pages could not be extracted by the OpenAI "
+                    "batch and were left empty in the output."
                 )
+            return [
+                parsed.get(f"{document.id}:{page_number}", MultipleTables(tables=[]))
+                for document, page_number in jobs
             ]
+
+        # Pace requests up front so we stay under OpenAI's limits instead of retrying
+        rpm_limiter = AsyncLimiter(rpm, 60)
+        tpm_limiter = AsyncLimiter(tpm, 60)
+
+        http_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0))
+
+        @retry(
+            wait=wait_random(min=0.1, max=0.5) + wait_random_exponential(multiplier=0.5, max=10),
+            stop=stop_after_attempt(4),
+            retry=retry_if_exception(is_transient_fetch_error),
         )
+        async def fetch_image(url: str) -> httpx.Response:
+            """ Downloads the page image ourselves so OpenAI does not have to"""
+            response = await http_client.get(url, follow_redirects=True)
+            response.raise_for_status()
+            return response
 
-        @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-        def extract(url: str) -> MultipleTables:
-            tables = client.chat.completions.create(
-                model="gpt-4o",
-                max_tokens=4000,
-                response_model=MultipleTables,
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Describe this data accurately as a table"
-                                f" in markdown format. {example.model_dump_json(indent=2)}",
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {"url": url},
-                            },
-                            {
-                                "type": "text",
-                                "text": f"{final_prompt}",
-                            },
-                        ],
-                    }
-                ],
+        async def cached_extract(image: httpx.Response) -> MultipleTables:
+            """ Looks the page up in the on-disk cache before calling GPT 4o"""
+            content_type = image.headers.get("content-type", "image/gif").split(";")[0]
+            data_url = (
+                f"data:{content_type};base64,"
+                + base64.b64encode(image.content).decode("ascii")
             )
-
+            if not cache_dir:
+                return await extract(data_url)
+            key = cache_key(image.content, static_prefix, MODEL)
+            cache_file = os.path.join(cache_dir, f"{key}.json")
+            try:
+                # Cached tables are already normalized, so rebuild them directly
+                # rather than sending them back through the markdown validator
+                with open(cache_file, "rb") as cachefile:
+                    cached = orjson.loads(cachefile.read())
+                return MultipleTables.model_construct(
+                    tables=[
+                        Table.model_construct(
+                            caption=table["caption"],
+                            dataframe=pd.DataFrame(table["rows"], columns=table["columns"]),
+                        )
+                        for table in cached["tables"]
+                    ]
+                )
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as exc:
+                # A damaged entry is treated as a miss and overwritten below
+                print(f"Ignoring unreadable cache entry {cache_file}: {exc}")
+            tables = await extract(data_url)
+            payload = orjson.dumps(
+                {
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                    "model": MODEL,
+                    "prompt_version": PROMPT_VERSION,
+                    "prompt": final_prompt,
+                    "tables": [
+                        {
+                            "caption": table.caption,
+                            "columns": [str(column) for column in table.dataframe.columns],
+                            "rows": table.dataframe.values.tolist(),
+                        }
+                        for table in tables.tables
+                    ],
+                }
+            )
+            # Write to a temp file and swap it in so a killed run never
+            # leaves a truncated entry behind
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as cachefile:
+                    cachefile.write(payload)
+                os.replace(tmp_path, cache_file)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
             return tables
 
+        serializers = {
+            "csv": serialize_tables_to_csv,
+            "json": serialize_tables_to_json,
+        }
+        serialize = serializers.get(output_format)
+
         zip_filename = "all_tables.zip"
         zipf = zipfile.ZipFile(zip_filename, "w")  # Create a zip file
-        created_files = []  # Store the filenames of the created files
-
-        for document in self.get_documents():
-            outer_bound = end_page + 1
-            if end_page > document.page_count:
-                outer_bound = document.page_count + 1
-            if output_format == "csv":
-                csv_filename = f"tables-{document.id}.csv"
-                for page_number in range(start_page, outer_bound):
-                    image_url = document.get_large_image_url(page_number)
-                    tables = extract(image_url)
-                    save_tables_to_csv(tables.tables, csv_filename, page_number)
-                zipf.write(csv_filename)
-                created_files.append(csv_filename)
-            elif output_format == "json":
-                json_filename = f"tables-{document.id}.json"
-                for page_number in range(start_page, end_page + 1):
-                    image_url = document.get_large_image_url(page_number)
-                    tables = extract(image_url)
-                    save_tables_to_json(tables.tables, json_filename, page_number)
-                zipf.write(json_filename)
-                created_files.append(json_filename)
+
+        documents = self._docs
+        jobs = [
+            (document, page_number)
+            for document in documents
+            for page_number in range(
+                start_page, min(end_page, document.page_count) + 1
+            )
+        ]
+        page_counts = {document.id: 0 for document in documents}
+        for document, _ in jobs:
+            page_counts[document.id] += 1
+        # Serialized pages of documents that are not finished yet
+        finished_pages = {document.id: {} for document in documents}
+        page_tasks = []
+
+        def write_document(document, chunks):
+            """ Streams a document's serialized pages into its zip entry"""
+            if serialize is None:
+                return
+            filename = f"tables-{document.id}.{output_format}"
+            with zipf.open(filename, "w", force_zip64=True) as raw, io.TextIOWrapper(
+                raw, encoding="utf-8", newline=""
+            ) as outfile:
+                outfile.writelines(chunks)
+
+        # Pages serialize independently, so run them on worker threads. A page
+        # only starts once a slot is free, so a slow serializer stalls whoever
+        # submits pages instead of piling up tasks
+        serialize_slots = asyncio.Semaphore(os.cpu_count() or 4)
+
+        async def serialize_page(index, tables):
+            document, page_number = jobs[index]
+            try:
+                chunk = (
+                    await asyncio.to_thread(serialize, tables.tables, page_number)
+                    if serialize is not None
+                    else ""
+                )
+            finally:
+                serialize_slots.release()
+            # Write the document as soon as its last page is in and let go of its
+            # pages; nothing awaits in between, so zip writes never interleave
+            pages = finished_pages[document.id]
+            pages[page_number] = chunk
+            if len(pages) == page_counts[document.id]:
+                write_document(document, [pages[number] for number in sorted(pages)])
+                del finished_pages[document.id]
+
+        async def submit_page(index, tables):
+            await serialize_slots.acquire()
+            page_tasks.append(asyncio.create_task(serialize_page(index, tables)))
+
+        async def run_pipeline():
+            """ Runs fetch -> GPT 4o -> serialize/write as stages joined by bounded
+                queues, so each stage keeps working on the next page while later
+                stages handle earlier ones
+            """
+            fetch_q = asyncio.Queue()
+            infer_q = asyncio.Queue(maxsize=concurrency)
+            write_q = asyncio.Queue(maxsize=concurrency)
+            for index, (document, page_number) in enumerate(jobs):
+                fetch_q.put_nowait((index, document.get_large_image_url(page_number)))
+            for _ in range(concurrency):
+                fetch_q.put_nowait(None)
+
+            async def fetch_worker():
+                while (item := await fetch_q.get()) is not None:
+                    index, url = item
+                    await infer_q.put((index, await fetch_image(url)))
+
+            async def infer_worker():
+                while (item := await infer_q.get()) is not None:
+                    index, image = item
+                    await write_q.put((index, await cached_extract(image)))
+
+            async def fetch_stage():
+                await asyncio.gather(*[fetch_worker() for _ in range(concurrency)])
+                for _ in range(concurrency):
+                    await infer_q.put(None)
+
+            async def infer_stage():
+                await asyncio.gather(*[infer_worker() for _ in range(concurrency)])
+                await write_q.put(None)
+
+            async def write_stage():
+                while (item := await write_q.get()) is not None:
+                    # Blocks while every slot is busy, which backs up write_q
+                    # and in turn the inference and fetch stages
+                    await submit_page(*item)
+
+            await asyncio.gather(fetch_stage(), infer_stage(), write_stage())
+
+        # Documents with no pages in range still get an (empty) entry
+        for document in documents:
+            if page_counts[document.id] == 0:
+                write_document(document, [])
+        try:
+            if use_batch_api:
+                for index, tables in enumerate(await batch_extract(jobs)):
+                    await submit_page(index, tables)
+            else:
+                await run_pipeline()
+            await asyncio.gather(*page_tasks)
+        finally:
+            await http_client.aclose()
 
         zipf.close()  # Close the zip file
 
@@ -0,0 +1,41 @@
+import pandas as pd
+import pytest
+
+from main import md_to_df
+
+
+def test_separator_row_is_skipped():
+    df = md_to_df("| Name | Count |\n|:-----|------:|\n| a | 1 |\n| b | 2 |")
+    assert df.columns.tolist() == ["Name", "Count"]
+    assert df.values.tolist() == [["a", "1"], ["b", "2"]]
+
+
+def test_first_body_row_is_kept_without_separator():
+    df = md_to_df("| Name | Count |\n| a | 1 |")
+    assert df.values.tolist() == [["a", "1"]]
+
+
+def test_duplicate_and_blank_headers_are_suffixed():
+    df = md_to_df("|  |  | 2020 | 2020 |\n|---|---|---|---|\n| a | b | 1 | 2 |")
+    assert df.columns.tolist() == ["", ".1", "2020", "2020.1"]
+    assert len(df.to_dict()) == 4
+
+
+def test_suffix_does_not_collide_with_existing_header():
+    df = md_to_df("| x | x | x.1 |\n|---|---|---|\n| 1 | 2 | 3 |")
+    assert df.columns.tolist() == ["x", "x.1", "x.1.1"]
+
+
+def test_short_rows_are_padded():
+    df = md_to_df("| a | b | c |\n|---|---|---|\n| 1 |")
+    assert df.values.tolist() == [["1", "", ""]]
+
+
+def test_long_rows_raise():
+    with pytest.raises(ValueError):
+        md_to_df("| a | b |\n|---|---|\n| 1 | 2 | 3 |")
+
+
+def test_non_strings_pass_through():
+    df = pd.DataFrame({"a": [1]})
+    assert md_to_df(df) is df